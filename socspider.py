@@ -63,14 +63,202 @@ import os
 import traceback
 import random
 import datetime
+import math
+import zlib
+import gzip
+import struct
+import gc
+import itertools
+import collections.abc
+import concurrent.futures
 
+# Optional modules, only used for exporting the data in columnar format.
+# Parquet or Arrow IPC files require pyarrow, NumPy arrays are used
+# as a fallback.
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+    has_pyarrow = True
+except ImportError:
+    has_pyarrow = False
+try:
+    import numpy
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+# Optional module, used to compress snapshots with zstd instead of gzip.
+try:
+    import zstandard
+    has_zstd = True
+except ImportError:
+    has_zstd = False
+
+
+# HTTP archive, for offline reprocessing.
+#
+# In "record" mode, the URL, status and body of every Rest API response
+# are appended to the archive. In "replay" mode, the Rest API responses are
+# read from the archive instead of the network, so the extraction logic
+# can be rerun on previously crawled data at disk speed.
+#
+# The archive is made of two files: "<name>.data", which contains the
+# bodies, each compressed independently with zlib, and "<name>.idx",
+# which contains one JSON line per response with the URL, the status
+# and the position of the body in the data file. If the same URL was
+# recorded several times, the responses are replayed in the same order,
+# and the last one is repeated after that. URLs that are not in the
+# archive are replayed as failures, but do not mark the instance as failing.
+#
+# For the replay to repeat the recorded crawl, the spider must make the
+# same choices. A crawl is usually made of several runs of the program,
+# each starting from the data saved by the previous one, and several runs
+# can be recorded in the same archive. Each recording run starts with a
+# line holding the run identifier, the seed of the random generator, the
+# start time and the start instance, and each record holds the run
+# identifier and the time of the response. In both modes, the random
+# generator is seeded with the seed of the run, and the spider's clock
+# only advances with the time of the responses, so that "try after"
+# delays expire at the same points. The replay goes through all the
+# recorded runs in sequence, each one using only its own records and
+# starting from the data saved by the previous one. Replaying from the
+# same initial data as the first recorded run reproduces the whole crawl.
+class httpArchive:
+    def __init__(self, archive_name, replaying):
+        self.data_file = archive_name + ".data"
+        self.index_file = archive_name + ".idx"
+        self.replaying = replaying
+        # Recorded runs, in order, and their records per URL
+        self.runs = []
+        self.index = dict()
+        self.run_id = None
+        self.nb_records = 0
+        self.nb_missing = 0
+        self.last_missed = False
+        self.clock = datetime.datetime.now()
+        if replaying:
+            # The index is only needed for replay. When recording, new
+            # records are simply appended.
+            self.load_index()
+            self.F_data = open(self.data_file, "rb")
+            self.F_index = None
+        else:
+            self.F_data = open(self.data_file, "ab")
+            self.F_index = open(self.index_file, "at", encoding='utf-8')
+
+    def load_index(self):
+        run_by_id = dict()
+        with open(self.index_file, "rt", encoding='utf-8') as F:
+            for line in F:
+                try:
+                    jrec = json.loads(line)
+                    if "seed" in jrec:
+                        # Start of a recording run.
+                        run = { "run": jrec["run"], "seed": jrec["seed"], "time": jrec["time"],
+                            "start": jrec["start"], "index": dict() }
+                        run_by_id[run["run"]] = run
+                        self.runs.append(run)
+                        continue
+                    if not jrec["run"] in run_by_id:
+                        print("Record of unknown run in archive index: " + line.strip())
+                        continue
+                    run_index = run_by_id[jrec["run"]]["index"]
+                    url = jrec["url"]
+                    if not url in run_index:
+                        run_index[url] = []
+                    run_index[url].append((jrec["status"], jrec["offset"], jrec["length"], jrec["time"]))
+                    self.nb_records += 1
+                except Exception as e:
+                    print("Bad archive index line: " + line.strip() + ", exception: " + str(e))
+        print("Loaded " + str(self.nb_records) + " records of " + str(len(self.runs)) + " runs from " + self.index_file)
+
+    def begin_record(self, start_url):
+        # The run identifier is drawn from the system's entropy, so that
+        # runs recorded in the same archive are distinct without having to
+        # read the index.
+        self.run_id = random.SystemRandom().randrange(1 << 63)
+        seed = random.SystemRandom().randrange(1 << 32)
+        self.clock = datetime.datetime.now()
+        jrun = { "run": self.run_id, "seed": seed, "time": self.clock.timestamp(), "start": start_url }
+        self.F_index.write(json.dumps(jrun) + "\n")
+        self.F_index.flush()
+        random.seed(seed)
+
+    def begin_replay(self, run_number):
+        # Returns the start instance of the run.
+        run = self.runs[run_number]
+        self.run_id = run["run"]
+        self.index = run["index"]
+        self.clock = datetime.datetime.fromtimestamp(run["time"])
+        random.seed(run["seed"])
+        print("Replaying run " + str(run_number + 1) + " of " + str(len(self.runs)) + ", starting at " + run["start"])
+        return run["start"]
+
+    def record(self, url, status, text):
+        body = zlib.compress(text.encode('utf-8'))
+        self.F_data.seek(0, os.SEEK_END)
+        offset = self.F_data.tell()
+        self.F_data.write(body)
+        self.F_data.flush()
+        self.clock = datetime.datetime.now()
+        jrec = { "run": self.run_id, "url": url, "status": status, "offset": offset, "length": len(body),
+            "time": self.clock.timestamp() }
+        self.F_index.write(json.dumps(jrec) + "\n")
+        self.F_index.flush()
+        self.nb_records += 1
+
+    def replay(self, url):
+        self.last_missed = not url in self.index
+        if self.last_missed:
+            self.nb_missing += 1
+            return 0, ""
+        records = self.index[url]
+        status, offset, length, record_time = records[0]
+        if len(records) > 1:
+            self.index[url] = records[1:]
+        self.clock = datetime.datetime.fromtimestamp(record_time)
+        self.F_data.seek(offset)
+        text = zlib.decompress(self.F_data.read(length)).decode('utf-8')
+        return status, text
+
+    def close(self):
+        self.F_data.close()
+        if self.F_index != None:
+            self.F_index.close()
+        if self.replaying:
+            print("Replay: " + str(self.nb_missing) + " URL not found in the archive.")
+
+http_archive = None
+
+# Current time, as seen by the spider. When recording or replaying, this
+# is the time of the last response in the archive.
+def spiderNow():
+    if http_archive != None:
+        return http_archive.clock
+    return datetime.datetime.now()
 
 # Helper function for processing Rest API
 # TODO: may want to somehow add a timer.
 def restApi(url, timeout=5):
     success = False
+    if http_archive != None and http_archive.replaying:
+        try:
+            status, text = http_archive.replay(url)
+            if status == 200:
+                success = True
+                jresp = json.loads(text)
+            else:
+                jresp = json.loads("{}")
+        except Exception as e:
+            print("Cannot replay: " + url + ", exception: " + str(e))
+            success = False
+            jresp = json.loads("{}")
+        return success,jresp
+    response = None
     try:
         response = requests.get(url=url, timeout=timeout)
+        if http_archive != None:
+            http_archive.record(url, response.status_code, response.text)
         if response.status_code == 200:
             success = True
             jresp = json.loads(response.text)
@@ -79,6 +267,10 @@ def restApi(url, timeout=5):
             jresp = json.loads("{}")
     except Exception as e:
         print("Cannot process: " + url + ", exception: " + str(e))
+        if http_archive != None and response == None:
+            # Record the failure, so it is replayed as well.
+            http_archive.record(url, 0, "")
+        success = False
         jresp = json.loads("{}")
 
     return success,jresp
@@ -97,6 +289,9 @@ class socUser:
         self.acct = acct
         self.acct_id = acct_id
         self.seen_by = set()
+        # yield statistics of the "last statuses" requests for this account
+        self.nb_requests = 0
+        self.total_yield = 0
 
     def add_seen_by(self, instance_url, acct):
         added = 0
@@ -112,6 +307,9 @@ class socUser:
         F.write(", \"acct\": \"" + self.acct + "\"")
         if self.acct_id != "":
             F.write(", \"acct_id\": \"" + self.acct_id + "\"")
+        if self.nb_requests > 0:
+            F.write(", \"requests\": \"" + str(self.nb_requests) + "\"")
+            F.write(", \"yield\": \"" + str(self.total_yield) + "\"")
         if len(self.seen_by) > 0:
             F.write(", \"seen_by\": [")
             is_first = True
@@ -123,6 +321,16 @@ class socUser:
             F.write("]")
         F.write("}")
 
+    def to_row(self, instance_code):
+        return [ instance_code, self.acct, self.acct_id, self.nb_requests, self.total_yield, list(self.seen_by) ]
+
+    def from_row(row, instance_urls):
+        usr = socUser(instance_urls[row[0]], row[1], row[2])
+        usr.nb_requests = row[3]
+        usr.total_yield = row[4]
+        usr.seen_by = set(row[5])
+        return(usr)
+
     def from_json(jusr):
         try:
             instance_url = jusr["instance"]
@@ -131,6 +339,12 @@ class socUser:
             if "acct_id" in jusr:
                 acct_id = jusr["acct_id"]
             usr = socUser(instance_url, acct, acct_id)
+            if "requests" in jusr and "yield" in jusr:
+                try:
+                    usr.nb_requests = int(jusr["requests"])
+                    usr.total_yield = int(jusr["yield"])
+                except:
+                    print("Loading user: " + acct + ", bad yield statistics.")
             if "seen_by" in jusr:
                 for key in jusr["seen_by"]:
                     usr.seen_by.add(key)
@@ -152,6 +366,10 @@ class socToot:
         self.from_thread = from_thread
         self.favor = favor
         self.related = related
+        # Origin of the toot for the yield statistics: ("account", key)
+        # or ("instance", url) of the request that discovered it, or None.
+        # This is not saved.
+        self.origin = None
 
     def get_instance_url(self):
         url = ""
@@ -178,6 +396,13 @@ class socToot:
             F.write(", \"related\": \"" + str(self.related) + "\"")
         F.write("}")
 
+    def to_row(self):
+        return [ self.uri, self.toot_id, self.acct, self.source_id, self.local_instance, self.local_id,
+            int(self.from_thread), self.favor, self.related ]
+
+    def from_row(row):
+        return(socToot(row[0], row[1], row[2], row[3], row[4], row[5], row[6] == 1, row[7], row[8]))
+
     def from_json(jtoot):
         try:
             uri = jtoot["uri"]
@@ -224,20 +449,271 @@ class socInstance:
         self.try_after = datetime.datetime(1900, 1, 1)
         self.got_back_on = True
         self.failures = 0
+        # Yield statistics, i.e., number of new users, toots and seen_by
+        # relations learned per request, for the public timeline
+        # requests and for the account requests on that instance.
+        self.nb_requests = 0
+        self.total_yield = 0
+        self.acct_requests = 0
+        self.acct_yield = 0
     def is_failing(self):
-        return self.try_after > datetime.datetime.now()
+        return self.try_after > spiderNow()
     def just_failed(self):
+        if http_archive != None and http_archive.replaying and http_archive.last_missed:
+            # The query was not found in the archive, which says nothing
+            # about the instance.
+            return
         # We count the number of consecutive failures, or the
         # number of sucesses after a failure, so the time delta can be made
         self.got_back_on = False
         # progressively larger if failures persist
         self.failures += 1
-        self.try_after = datetime.datetime.now() + datetime.timedelta(seconds=30*self.failures)
+        self.try_after = spiderNow() + datetime.timedelta(seconds=30*self.failures)
     def back_on(self):
         if not self.got_back_on:
             print(self.url + " back on after " + str(self.failures) + " failures.")
         self.got_back_on = True
         self.failures = 0
+    def acct_mean_yield(self):
+        if self.acct_requests == 0:
+            return 0.0
+        return self.acct_yield / self.acct_requests
+
+# Yield based selection
+#
+# Picking instances and accounts uniformly at random wastes many requests
+# on small or idle instances. Instead, we treat each instance and each
+# account as the "arm" of a multi-armed bandit, whose reward is the yield
+# of a request: the number of new users, new toots and new seen_by
+# relations that it produced. We select the arm with the highest "upper
+# confidence bound" (UCB1), i.e., the average yield plus an exploration
+# bonus that decreases as the arm gets tried more often. Arms that were
+# never tried get the highest priority. The bonus is scaled by the global
+# average yield, because yields are not normalized to [0,1].
+def ucbScore(mean_yield, nb_requests, total_requests, scale, explore=1.0):
+    if nb_requests == 0:
+        return math.inf
+    bonus = explore * scale * math.sqrt(2.0 * math.log(total_requests + 1) / nb_requests)
+    return mean_yield + bonus
+
+# Columnar export
+#
+# Instance URL and acct columns contain lots of repeated values. They are
+# exported as "dictionary encoded" columns: an array of integer codes,
+# plus a dictionary holding each distinct value once.
+class columnDictionary:
+    def __init__(self):
+        self.codes = dict()
+        self.values = []
+
+    def encode(self, value):
+        if not value in self.codes:
+            self.codes[value] = len(self.values)
+            self.values.append(value)
+        return self.codes[value]
+
+def splitUserKey(key):
+    # User keys are formatted as <instance_url>"/"<acct>, with acct
+    # starting with "@".
+    sep = key.rfind("/@")
+    if sep < 0:
+        sep = key.rfind("/")
+    if sep < 0:
+        return "", key
+    return key[:sep], key[sep+1:]
+
+# Snapshot format
+#
+# Large data files are slow to copy and to load. The snapshot format,
+# used for data files named "*.snap", stores the same data as the JSON
+# format, but split in chunks of at most snapshot_chunk_size entries.
+# Each chunk is compressed independently with zstd if available or gzip
+# otherwise. The file starts with the magic string "SOCSNAP1", followed by
+# the length of the index as 8 bytes in network order, by the index
+# in JSON format, and by the chunks. The index lists for each chunk the
+# section ("instances", "instance_stats", "users", "toots" or
+# "toots_todo"), the codec, and the offset and length of the chunk
+# after the end of the index.
+#
+# Each chunk is a compact JSON value. Users and toots are encoded as lists
+# of values rather than objects, see socUser.to_row and socToot.to_row,
+# which are much faster to parse. The instance URLs of the users in a
+# chunk are replaced by their position in a list at the start of the chunk.
+#
+# Compression and decompression release the global interpreter lock, so
+# they run in a thread pool, while the main thread encodes or parses the
+# other chunks. Parsing the JSON and creating the objects is done in the
+# main thread, because passing objects between processes costs about as
+# much as creating them.
+snapshot_magic = b"SOCSNAP1"
+snapshot_chunk_size = 20000
+
+def isSnapshot(file_name):
+    with open(file_name, "rb") as F:
+        return F.read(len(snapshot_magic)) == snapshot_magic
+
+def compressChunk(codec, data):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return gzip.compress(data, compresslevel=1)
+
+def decompressChunk(codec, data):
+    if codec == "zstd":
+        if not has_zstd:
+            raise Exception("Module zstandard is required to load zstd chunks.")
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif codec == "gzip":
+        return gzip.decompress(data)
+    raise Exception("Unknown snapshot codec: " + codec)
+
+def parseSnapshotChunk(section, data):
+    # Users and toots are returned as objects, instance statistics in the
+    # same format as in the JSON files, other sections as JSON values.
+    jchunk = json.loads(data)
+    if section == "users":
+        instance_urls = jchunk["instances"]
+        return [ socUser.from_row(row, instance_urls) for row in jchunk["rows"] ]
+    elif section == "toots":
+        return [ socToot.from_row(row) for row in jchunk ]
+    elif section == "instance_stats":
+        return [ { "instance": row[0], "requests": row[1], "yield": row[2],
+            "acct_requests": row[3], "acct_yield": row[4] } for row in jchunk ]
+    return jchunk
+
+def readSnapshot(file_name):
+    with open(file_name, "rb") as F:
+        if F.read(len(snapshot_magic)) != snapshot_magic:
+            raise Exception("Not a snapshot file: " + file_name)
+        index_length = struct.unpack("!Q", F.read(8))[0]
+        jindex = json.loads(F.read(index_length).decode('utf-8'))
+        contents = F.read()
+    print("Loaded " + str(len(contents) + index_length + 16) + " bytes from " + file_name)
+    chunks = jindex["chunks"]
+    codecs = [ chunk["codec"] for chunk in chunks ]
+    datas = [ contents[chunk["offset"]:chunk["offset"] + chunk["length"]] for chunk in chunks ]
+    jfile = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        # Results are produced in the order of the chunks, while the next
+        # chunks are decompressed in the background.
+        i = 0
+        for data in executor.map(decompressChunk, codecs, datas):
+            section = chunks[i]["section"]
+            if not section in jfile:
+                jfile[section] = []
+            jfile[section] += parseSnapshotChunk(section, data)
+            i += 1
+    return jfile
+
+# Read only view of a set. Set operations such as union or intersection
+# return frozen sets.
+class readOnlySet(collections.abc.Set):
+    def __init__(self, values):
+        self.values = values
+
+    def __contains__(self, value):
+        return value in self.values
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return "readOnlySet(" + repr(self.values) + ")"
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return frozenset(iterable)
+
+# Graph index
+#
+# The "seen_by" relations are stored on the seen user. Finding whom an
+# account sees, or which users of an instance are seen from another
+# instance, would require a scan of the whole user list. The graph index
+# keeps the following dictionaries. It is only built by the spider when
+# first needed, by get_graph(), and then updated as users and relations
+# are learned:
+# - reverse: user key -> set of keys by which the user is seen. This is
+#   the "seen_by" set of the user object itself, not a copy.
+# - forward: user key -> set of keys of the users that it sees.
+# - members: instance url -> set of keys of the users on that instance.
+# - pairs: (instance url, seen by instance url) -> set of keys of the users
+#   on the first instance that are seen by users of the second.
+class socGraphIndex:
+    def __init__(self):
+        self.reverse = dict()
+        self.forward = dict()
+        self.members = dict()
+        self.pairs = dict()
+
+    def add_user(self, usr):
+        key = usr.instance_url + "/" + usr.acct
+        if not key in self.reverse:
+            self.reverse[key] = usr.seen_by
+            if not usr.instance_url in self.members:
+                self.members[usr.instance_url] = set()
+            self.members[usr.instance_url].add(key)
+            for seen_by_key in usr.seen_by:
+                self.add_edge(usr, key, seen_by_key)
+
+    def add_edge(self, usr, key, seen_by_key):
+        if not seen_by_key in self.forward:
+            self.forward[seen_by_key] = set()
+        self.forward[seen_by_key].add(key)
+        seen_by_instance, seen_by_acct = splitUserKey(seen_by_key)
+        pair = (usr.instance_url, seen_by_instance)
+        if not pair in self.pairs:
+            self.pairs[pair] = set()
+        self.pairs[pair].add(key)
+
+    # The query results are read only views of the sets of the index,
+    # which do not copy them. Callers that need a copy can use
+    # frozenset(result) or set(result).
+    def seen_by(self, key):
+        if key in self.reverse:
+            return readOnlySet(self.reverse[key])
+        return readOnlySet(set())
+
+    def sees(self, key):
+        if key in self.forward:
+            return readOnlySet(self.forward[key])
+        return readOnlySet(set())
+
+    def neighbours(self, key):
+        return self.seen_by(key) | self.sees(key)
+
+    def instance_members(self, instance_url):
+        if instance_url in self.members:
+            return readOnlySet(self.members[instance_url])
+        return readOnlySet(set())
+
+    def instance_pair(self, instance_url, seen_by_instance):
+        if (instance_url, seen_by_instance) in self.pairs:
+            return readOnlySet(self.pairs[(instance_url, seen_by_instance)])
+        return readOnlySet(set())
+
+    def k_hop(self, key, k, direction="both"):
+        # Breadth first search, returns a dictionary of the keys found
+        # within k hops, with their distance to the start key. The
+        # direction is "sees", "seen_by" or "both".
+        found = { key: 0 }
+        frontier = [ key ]
+        for hop in range(1, k+1):
+            next_frontier = []
+            for current in frontier:
+                adjacent = []
+                if direction != "seen_by" and current in self.forward:
+                    adjacent.append(self.forward[current])
+                if direction != "sees" and current in self.reverse:
+                    adjacent.append(self.reverse[current])
+                for other in itertools.chain(*adjacent):
+                    if not other in found:
+                        found[other] = hop
+                        next_frontier.append(other)
+            frontier = next_frontier
+        del found[key]
+        return found
 
 class socSpider:
     def __init__(self):
@@ -251,12 +727,29 @@ class socSpider:
         self.toot_todo = []
         self.nb_seen_by = 0
         self.nb_user_full = 0
+        # Global yield statistics, used by the bandit selection.
+        self.instance_requests = 0
+        self.instance_yield = 0
+        self.acct_requests = 0
+        self.acct_yield = 0
         # Journal classes: entries that have been touched in the current run
         # TODO: this is work in progress, to enable saving journals instead
         # of serving state. In 
         self.instance_touch = set()
         self.user_touch = set()
         self.toot_touch = set()
+        # Origin to which the yield of the current request is credited
+        self.current_origin = None
+        # Graph index, for fast queries of the seen_by relations. Only
+        # built when needed, see get_graph().
+        self.graph = None
+
+    def get_graph(self):
+        if self.graph == None:
+            self.graph = socGraphIndex()
+            for key in self.user_list:
+                self.graph.add_user(self.user_list[key])
+        return self.graph
 
     def learnInstance(self, instance_url):
         if not instance_url in self.instance_list:
@@ -271,6 +764,8 @@ class socSpider:
         else:
             usr = socUser(instance_url, acct, acct_id)
             self.user_list[key]=usr
+            if self.graph != None:
+                self.graph.add_user(usr)
             self.learnInstance(instance_url)
             self.user_touch.add(key)
         if acct_id != "" and usr.acct_id == "":
@@ -284,11 +779,14 @@ class socSpider:
         n = usr.add_seen_by(seen_by_instance, seen_by_acct)
         if n > 0:
             self.nb_seen_by += n
+            if self.graph != None:
+                self.graph.add_edge(usr, instance_url + "/" + acct, seen_by_instance + "/" + seen_by_acct)
             self.user_touch.add(usr.instance_url+"/"+usr.acct)
 
     def learnToot(self, uri, toot_id, acct, local_instance, local_id, from_thread, favor, related):
         if not uri in self.toot_list:
             toot = socToot(uri, toot_id, acct, "", local_instance, local_id, from_thread, favor, related)
+            toot.origin = self.current_origin
             self.toot_list[uri]=toot
             self.toot_touch.add(uri)
             self.toot_todo.append(uri)
@@ -532,30 +1030,112 @@ class socSpider:
             current_list = self.toot_todo
             self.toot_todo = []
         for key in current_list:
+            # The yield of processing a toot is credited to the account or
+            # instance whose request discovered it. Toots discovered while
+            # processing it inherit the same origin.
+            origin = None
+            if key in self.toot_list:
+                origin = self.toot_list[key].origin
+            self.current_origin = origin
+            before = self.crawlCounters()
             self.processTootId(key)
+            self.creditYield(origin, self.crawlCounters() - before)
+            self.current_origin = None
+
+    def crawlCounters(self):
+        return len(self.user_list) + len(self.toot_list) + self.nb_seen_by
+
+    def creditYield(self, origin, new_yield):
+        if origin == None or new_yield == 0:
+            return
+        kind, key = origin
+        if kind == "account":
+            if key in self.user_list:
+                usr = self.user_list[key]
+                usr.total_yield += new_yield
+                if usr.instance_url in self.instance_list:
+                    self.instance_list[usr.instance_url].acct_yield += new_yield
+            self.acct_yield += new_yield
+        elif kind == "instance":
+            if key in self.instance_list:
+                self.instance_list[key].total_yield += new_yield
+            self.instance_yield += new_yield
 
     def processRandomAccount(self):
-        success = False
+        # Draw up to 10 random candidates, as before, but instead of reading
+        # the first eligible one, read the one with the best yield score.
+        # Accounts that were never read inherit the average yield of the
+        # accounts on their instance.
+        best_key = ""
+        best_score = -1.0
+        nb_candidates = 0
+        acct_scale = 1.0
+        if self.acct_requests > 0:
+            acct_scale = max(1.0, self.acct_yield / self.acct_requests)
         for i in range(0,10):
             acct_key = random.choice(list(self.user_list))
             usr = self.user_list[acct_key]
             if usr.acct_id != "" and not self.instance_list[usr.instance_url].is_failing():
-                success = True
-                print("Found " + acct_key + " after " + str(i+1) + " random picks.")
-                self.processAccount(self.user_list[acct_key])
-                break
-        if not success:
+                nb_candidates += 1
+                instance = self.instance_list[usr.instance_url]
+                if usr.nb_requests > 0:
+                    score = ucbScore(usr.total_yield / usr.nb_requests, usr.nb_requests, self.acct_requests, acct_scale)
+                else:
+                    score = ucbScore(instance.acct_mean_yield(), instance.acct_requests, self.acct_requests, acct_scale)
+                if score > best_score:
+                    best_score = score
+                    best_key = acct_key
+        if best_key == "":
             print("Cannot find a suitable account after 10 trials")
-        return(success)
+            return(False)
+        print("Selected " + best_key + " among " + str(nb_candidates) + " candidates.")
+        usr = self.user_list[best_key]
+        origin = ("account", best_key)
+        self.current_origin = origin
+        before = self.crawlCounters()
+        self.processAccount(usr)
+        usr.nb_requests += 1
+        if usr.instance_url in self.instance_list:
+            self.instance_list[usr.instance_url].acct_requests += 1
+        self.acct_requests += 1
+        self.creditYield(origin, self.crawlCounters() - before)
+        self.current_origin = None
+        return(True)
 
     def processRandomInstance(self):
-        success = False
-        instance_url = ""
-        for i in range(0,10):
+        # Pick the instance with the best yield score. Ties, such as between
+        # instances that were never tried, are broken at random.
+        best_score = -1.0
+        best_list = []
+        instance_scale = 1.0
+        if self.instance_requests > 0:
+            instance_scale = max(1.0, self.instance_yield / self.instance_requests)
+        for instance_url in self.instance_list:
+            instance = self.instance_list[instance_url]
+            if instance.is_failing():
+                continue
+            mean_yield = 0.0
+            if instance.nb_requests > 0:
+                mean_yield = instance.total_yield / instance.nb_requests
+            score = ucbScore(mean_yield, instance.nb_requests, self.instance_requests, instance_scale)
+            if score > best_score:
+                best_score = score
+                best_list = [instance_url]
+            elif score == best_score:
+                best_list.append(instance_url)
+        if len(best_list) == 0:
+            # All instances are failing, retry one anyway.
             instance_url = random.choice(list(self.instance_list))
-            if not self.instance_list[instance_url].is_failing():
-                break
+        else:
+            instance_url = random.choice(best_list)
+        origin = ("instance", instance_url)
+        self.current_origin = origin
+        before = self.crawlCounters()
         self.processInstance(instance_url)
+        self.instance_list[instance_url].nb_requests += 1
+        self.instance_requests += 1
+        self.creditYield(origin, self.crawlCounters() - before)
+        self.current_origin = None
 
     def loop(self, start='https://mastodon.social/', new_users=100, new_toots=1000, loops_max=100):
         nb_loops = 0
@@ -590,6 +1170,23 @@ class socSpider:
             F.write("        \"" + instance_url + "\"")
         F.write("]");
 
+    def save_instance_stats(self, F):
+        is_first = True
+        F.write("    \"instance_stats\":[")
+        for instance_url in self.instance_list:
+            instance = self.instance_list[instance_url]
+            if instance.nb_requests == 0 and instance.acct_requests == 0:
+                continue
+            if not is_first:
+                F.write(",")
+            is_first = False
+            F.write("\n        { \"instance\": \"" + instance_url + "\"")
+            F.write(", \"requests\": \"" + str(instance.nb_requests) + "\"")
+            F.write(", \"yield\": \"" + str(instance.total_yield) + "\"")
+            F.write(", \"acct_requests\": \"" + str(instance.acct_requests) + "\"")
+            F.write(", \"acct_yield\": \"" + str(instance.acct_yield) + "\"}")
+        F.write("]");
+
     def save_toots(self, F):
         is_first = True
         F.write("    \"toots\":[\n")
@@ -623,11 +1220,16 @@ class socSpider:
         F.write("]");
 
     def save(self, spider_data_file):
+        if spider_data_file.endswith(".snap"):
+            self.save_snapshot(spider_data_file)
+            return
         try:
             with open(spider_data_file, "wt",  encoding='utf-8') as F:
                 F.write("{")
                 self.save_instances(F)
                 F.write(",\n")
+                self.save_instance_stats(F)
+                F.write(",\n")
                 self.save_users(F)
                 F.write(",\n")
                 self.save_toots(F)
@@ -639,29 +1241,128 @@ class socSpider:
             traceback.print_exc()
             print("\nException: " + str(e))
 
+    def snapshot_chunks(self):
+        # Produce the encoded data of each chunk, as (section, bytes)
+        instance_urls = list(self.instance_list)
+        for i in range(0, len(instance_urls), snapshot_chunk_size):
+            yield "instances", instance_urls[i:i+snapshot_chunk_size]
+        stats = []
+        for instance_url in self.instance_list:
+            instance = self.instance_list[instance_url]
+            if instance.nb_requests > 0 or instance.acct_requests > 0:
+                stats.append([ instance_url, instance.nb_requests, instance.total_yield,
+                    instance.acct_requests, instance.acct_yield ])
+        yield "instance_stats", stats
+        keys = list(self.user_list)
+        for i in range(0, len(keys), snapshot_chunk_size):
+            instance_dict = columnDictionary()
+            rows = []
+            for key in keys[i:i+snapshot_chunk_size]:
+                usr = self.user_list[key]
+                rows.append(usr.to_row(instance_dict.encode(usr.instance_url)))
+            yield "users", { "instances": instance_dict.values, "rows": rows }
+        keys = list(self.toot_list)
+        for i in range(0, len(keys), snapshot_chunk_size):
+            yield "toots", [ self.toot_list[key].to_row() for key in keys[i:i+snapshot_chunk_size] ]
+        for i in range(0, len(self.toot_todo), snapshot_chunk_size):
+            yield "toots_todo", self.toot_todo[i:i+snapshot_chunk_size]
+
+    def save_snapshot(self, spider_data_file):
+        codec = "gzip"
+        if has_zstd:
+            codec = "zstd"
+        # As in load, encoding creates many short lived lists, which would
+        # trigger useless garbage collections.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            sections = []
+            futures = []
+            with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                # Each chunk is compressed in the background while the
+                # next one is encoded.
+                for section, jchunk in self.snapshot_chunks():
+                    data = json.dumps(jchunk, separators=(',', ':')).encode('utf-8')
+                    sections.append(section)
+                    futures.append(executor.submit(compressChunk, codec, data))
+                datas = [ future.result() for future in futures ]
+            jindex = { "version": 1, "chunks": [] }
+            offset = 0
+            for i in range(0, len(datas)):
+                jindex["chunks"].append({ "section": sections[i], "codec": codec,
+                    "offset": offset, "length": len(datas[i]) })
+                offset += len(datas[i])
+            index_data = json.dumps(jindex).encode('utf-8')
+            with open(spider_data_file, "wb") as F:
+                F.write(snapshot_magic)
+                F.write(struct.pack("!Q", len(index_data)))
+                F.write(index_data)
+                for data in datas:
+                    F.write(data)
+        except Exception as e:
+            print("Cannot save snapshot: " + spider_data_file)
+            traceback.print_exc()
+            print("\nException: " + str(e))
+        if gc_enabled:
+            gc.enable()
+
+    def load_instance_stats(self, jstat):
+        try:
+            instance_url = jstat["instance"]
+            if not instance_url in self.instance_list:
+                self.instance_list[instance_url] = socInstance(instance_url)
+            instance = self.instance_list[instance_url]
+            instance.nb_requests = int(jstat["requests"])
+            instance.total_yield = int(jstat["yield"])
+            instance.acct_requests = int(jstat["acct_requests"])
+            instance.acct_yield = int(jstat["acct_yield"])
+            self.instance_requests += instance.nb_requests
+            self.instance_yield += instance.total_yield
+        except Exception as e:
+            print("Cannot load instance statistics: " + str(jstat))
+            print("Exception: " + str(e))
+
     def load(self, spider_data_file):
+        jfile = dict()
+        # Loaded users replace those with the same key, so the graph index
+        # would be stale. It will be rebuilt on the next query.
+        self.graph = None
+        # Loading creates millions of objects, which would trigger many
+        # useless garbage collections.
+        gc_enabled = gc.isenabled()
+        gc.disable()
         try:
-            file_contents = ""
-            with open(spider_data_file, "rt",  encoding='utf-8') as F:
-                file_contents = F.read()
-            print("Loaded " + str(len(file_contents)) + " bytes from " + spider_data_file)
-            jfile = json.loads(file_contents)
+            if isSnapshot(spider_data_file):
+                jfile = readSnapshot(spider_data_file)
+            else:
+                file_contents = ""
+                with open(spider_data_file, "rt",  encoding='utf-8') as F:
+                    file_contents = F.read()
+                print("Loaded " + str(len(file_contents)) + " bytes from " + spider_data_file)
+                jfile = json.loads(file_contents)
+                if "users" in jfile:
+                    jfile["users"] = [ socUser.from_json(jusr) for jusr in jfile["users"] ]
+                if "toots" in jfile:
+                    jfile["toots"] = [ socToot.from_json(jtoot) for jtoot in jfile["toots"] ]
             if "instances" in jfile:
                 for instance_url in jfile["instances"]:
                     if not instance_url in self.instance_list:
                         self.instance_list[instance_url] = socInstance(instance_url)
+            if "instance_stats" in jfile:
+                for jstat in jfile["instance_stats"]:
+                    self.load_instance_stats(jstat)
             if "users" in jfile:
-                for jusr in jfile["users"]:
-                    usr = socUser.from_json(jusr)
+                for usr in jfile["users"]:
                     if usr != None:
                         key = usr.instance_url + "/" + usr.acct
                         self.user_list[key] = usr
                         self.nb_seen_by += len(usr.seen_by)
                         if usr.acct_id != "":
                             self.nb_user_full += 1
+                        self.acct_requests += usr.nb_requests
+                        self.acct_yield += usr.total_yield
             if "toots" in jfile:
-                for jtoot in jfile["toots"]:
-                    toot = socToot.from_json(jtoot)
+                for toot in jfile["toots"]:
                     if toot != None:
                         key = toot.uri
                         self.toot_list[key] = toot
@@ -672,6 +1373,8 @@ class socSpider:
             print("Cannot open: " + spider_data_file)
             traceback.print_exc()
             print("\nException: " + str(e))
+        if gc_enabled:
+            gc.enable()
         print("\nLoaded " + str(len(self.instance_list)) + " instances, " + \
                 str(len(self.user_list)) + " users (" + str(self.nb_user_full) + "), " +  \
                 str(self.nb_seen_by) + " seen_by, " + \
@@ -682,6 +1385,166 @@ class socSpider:
                 print(key)
             exit(1)
 
+    # Queries of the graph index, from the command line.
+    def query(self, query_args):
+        if len(query_args) < 2:
+            return False
+        query_type = query_args[0]
+        graph = self.get_graph()
+        start_time = datetime.datetime.now()
+        if query_type == "sees" and len(query_args) == 2:
+            result = graph.sees(query_args[1])
+        elif query_type == "seen_by" and len(query_args) == 2:
+            result = graph.seen_by(query_args[1])
+        elif query_type == "neighbours" and len(query_args) == 2:
+            result = graph.neighbours(query_args[1])
+        elif query_type == "members" and len(query_args) == 2:
+            result = graph.instance_members(query_args[1])
+        elif query_type == "pair" and len(query_args) == 3:
+            result = graph.instance_pair(query_args[1], query_args[2])
+        elif query_type == "khop" and len(query_args) >= 3 and len(query_args) <= 4:
+            direction = "both"
+            if len(query_args) == 4:
+                direction = query_args[3]
+            if not query_args[2].isdigit() or not direction in [ "sees", "seen_by", "both" ]:
+                return False
+            result = graph.k_hop(query_args[1], int(query_args[2]), direction)
+        else:
+            return False
+        duration = datetime.datetime.now() - start_time
+        for key in sorted(result):
+            if query_type == "khop":
+                print(key + " " + str(result[key]))
+            else:
+                print(key)
+        print("Found " + str(len(result)) + " results in " + str(duration.total_seconds()*1000) + " ms.")
+        return True
+
+    # Export in columnar format.
+    # The users, toots and seen_by relations are exported as three tables,
+    # "users", "toots" and "seen_by", in one file per table. In the "seen_by"
+    # table, each row is an edge from the row number of the seen user in the
+    # "users" table, to the instance and acct by which it was seen, plus the row
+    # number of that user in the "users" table if known, or -1 if not.
+    # The format can be "parquet" or "arrow" (Arrow IPC), which require pyarrow,
+    # or "numpy", in which case each table is saved as a ".npz" archive
+    # containing one array per column, and one "<column>_dict" array per
+    # dictionary encoded column.
+    def export_tables(self):
+        instance_dict = columnDictionary()
+        acct_dict = columnDictionary()
+        user_row = dict()
+        users = { "instance": [], "acct": [], "acct_id": [] }
+        for key in self.user_list:
+            usr = self.user_list[key]
+            user_row[key] = len(user_row)
+            users["instance"].append(instance_dict.encode(usr.instance_url))
+            users["acct"].append(acct_dict.encode(usr.acct))
+            users["acct_id"].append(usr.acct_id)
+        seen_by = { "user": [], "instance": [], "acct": [], "seen_by_user": [] }
+        for key in self.user_list:
+            row = user_row[key]
+            for seen_key in self.user_list[key].seen_by:
+                instance_url, acct = splitUserKey(seen_key)
+                seen_by["user"].append(row)
+                seen_by["instance"].append(instance_dict.encode(instance_url))
+                seen_by["acct"].append(acct_dict.encode(acct))
+                if seen_key in user_row:
+                    seen_by["seen_by_user"].append(user_row[seen_key])
+                else:
+                    seen_by["seen_by_user"].append(-1)
+        toots = { "uri": [], "toot_id": [], "instance": [], "acct": [], "source_id": [],
+            "local_instance": [], "local_id": [], "from_thread": [], "favor": [], "related": [] }
+        for key in self.toot_list:
+            toot = self.toot_list[key]
+            toots["uri"].append(toot.uri)
+            toots["toot_id"].append(toot.toot_id)
+            toots["instance"].append(instance_dict.encode(toot.get_instance_url()))
+            toots["acct"].append(acct_dict.encode(toot.acct))
+            toots["source_id"].append(toot.source_id)
+            toots["local_instance"].append(instance_dict.encode(toot.local_instance))
+            toots["local_id"].append(toot.local_id)
+            toots["from_thread"].append(toot.from_thread)
+            toots["favor"].append(toot.favor)
+            toots["related"].append(toot.related)
+        tables = { "users": users, "toots": toots, "seen_by": seen_by }
+        dictionaries = { "instance": instance_dict.values, "local_instance": instance_dict.values,
+            "acct": acct_dict.values }
+        return tables, dictionaries
+
+    def export_pyarrow(self, tables, dictionaries, export_dir, format):
+        for name in tables:
+            columns = tables[name]
+            arrays = []
+            for column in columns:
+                if column in dictionaries:
+                    array = pyarrow.DictionaryArray.from_arrays(
+                        pyarrow.array(columns[column], type=pyarrow.int32()),
+                        pyarrow.array(dictionaries[column], type=pyarrow.string()))
+                elif column in [ "user", "seen_by_user" ]:
+                    array = pyarrow.array(columns[column], type=pyarrow.int64())
+                else:
+                    array = pyarrow.array(columns[column])
+                arrays.append(array)
+            table = pyarrow.Table.from_arrays(arrays, names=list(columns))
+            if format == "parquet":
+                file_name = os.path.join(export_dir, name + ".parquet")
+                pyarrow.parquet.write_table(table, file_name)
+            else:
+                file_name = os.path.join(export_dir, name + ".arrow")
+                with pyarrow.OSFile(file_name, "wb") as sink:
+                    with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                        writer.write_table(table)
+            print("Exported " + str(table.num_rows) + " rows to " + file_name)
+
+    def export_numpy(self, tables, dictionaries, export_dir):
+        for name in tables:
+            columns = tables[name]
+            arrays = dict()
+            for column in columns:
+                if column in dictionaries:
+                    arrays[column] = numpy.array(columns[column], dtype=numpy.int32)
+                    arrays[column + "_dict"] = numpy.array(dictionaries[column], dtype=str)
+                elif column in [ "user", "seen_by_user" ]:
+                    arrays[column] = numpy.array(columns[column], dtype=numpy.int64)
+                else:
+                    arrays[column] = numpy.array(columns[column])
+            file_name = os.path.join(export_dir, name + ".npz")
+            numpy.savez(file_name, **arrays)
+            nb_rows = 0
+            for column in columns:
+                nb_rows = len(columns[column])
+                break
+            print("Exported " + str(nb_rows) + " rows to " + file_name)
+
+    def export(self, export_dir, format="parquet"):
+        if format in [ "parquet", "arrow" ] and not has_pyarrow:
+            if has_numpy:
+                print("Module pyarrow not available, exporting NumPy arrays instead.")
+                format = "numpy"
+            else:
+                print("Cannot export in " + format + " format, module pyarrow is not available.")
+                return False
+        elif format == "numpy" and not has_numpy:
+            print("Cannot export in numpy format, module numpy is not available.")
+            return False
+        elif not format in [ "parquet", "arrow", "numpy" ]:
+            print("Unknown export format: " + format)
+            return False
+        try:
+            os.makedirs(export_dir, exist_ok=True)
+            tables, dictionaries = self.export_tables()
+            if format == "numpy":
+                self.export_numpy(tables, dictionaries, export_dir)
+            else:
+                self.export_pyarrow(tables, dictionaries, export_dir, format)
+        except Exception as e:
+            print("Cannot export to: " + export_dir)
+            traceback.print_exc()
+            print("\nException: " + str(e))
+            return False
+        return True
+
     # Parallel processing.
     # If there are enough "todo toots" available, we can "split the load" by
     # splitting the toot_todo list in N buckets, then have each bucket resolved in a
@@ -743,17 +1606,83 @@ class socSpider:
 
 # main
 
-url = "https://mastodon.social"
-if len(sys.argv) > 3 or len(sys.argv) < 2:
-    print("Usage: " + sys.argv[0] + "<json data file> [instance url]")
+def usage():
+    print("Usage: " + sys.argv[0] + " <json data file> [instance url]")
+    print("       " + sys.argv[0] + " -record <archive> <json data file> [instance url]")
+    print("       " + sys.argv[0] + " -replay <archive> <json data file>")
+    print("       " + sys.argv[0] + " -export <json data file> <export directory> [parquet|arrow|numpy]")
+    print("       " + sys.argv[0] + " -convert <json data file> <new data file>")
+    print("       " + sys.argv[0] + " -query <json data file> <query>")
+    print("Queries:")
+    print("    sees <user key>")
+    print("    seen_by <user key>")
+    print("    neighbours <user key>")
+    print("    khop <user key> <k> [sees|seen_by|both]")
+    print("    members <instance url>")
+    print("    pair <instance url> <seen by instance url>")
+    print("User keys are formatted as <instance url>/@<acct>.")
+    print("Data files named *.snap are saved in the compressed snapshot format.")
     exit(1)
-elif len(sys.argv) == 3:
-    url = sys.argv[2]
-spider_data_file = sys.argv[1]
-spider = socSpider()
-if os.path.isfile(spider_data_file):
-    spider.load(spider_data_file)
-spider.loop(start=url)
-spider.save(spider_data_file)
-
 
+# The main program only runs when this file is executed as a script, so
+# that the spider classes can also be imported as a library.
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        usage()
+    elif sys.argv[1] == "-export":
+        if len(sys.argv) < 4 or len(sys.argv) > 5:
+            usage()
+        spider_data_file = sys.argv[2]
+        export_format = "parquet"
+        if len(sys.argv) == 5:
+            export_format = sys.argv[4]
+        spider = socSpider()
+        spider.load(spider_data_file)
+        if not spider.export(sys.argv[3], export_format):
+            exit(1)
+    elif sys.argv[1] == "-convert":
+        if len(sys.argv) != 4:
+            usage()
+        spider = socSpider()
+        spider.load(sys.argv[2])
+        spider.save(sys.argv[3])
+    elif sys.argv[1] == "-query":
+        if len(sys.argv) < 5:
+            usage()
+        spider = socSpider()
+        spider.load(sys.argv[2])
+        if not spider.query(sys.argv[3:]):
+            usage()
+    else:
+        url = "https://mastodon.social"
+        arg_first = 1
+        if sys.argv[1] == "-record" or sys.argv[1] == "-replay":
+            if len(sys.argv) < 4:
+                usage()
+            http_archive = httpArchive(sys.argv[2], sys.argv[1] == "-replay")
+            arg_first = 3
+        if len(sys.argv) > arg_first + 2 or (sys.argv[1] == "-replay" and len(sys.argv) > arg_first + 1):
+            usage()
+        elif len(sys.argv) == arg_first + 2:
+            url = sys.argv[arg_first + 1]
+        spider_data_file = sys.argv[arg_first]
+        if sys.argv[1] == "-replay":
+            # Replay the recorded runs in sequence, as if the program had
+            # been run once per recorded run.
+            for run_number in range(0, len(http_archive.runs)):
+                url = http_archive.begin_replay(run_number)
+                spider = socSpider()
+                if os.path.isfile(spider_data_file):
+                    spider.load(spider_data_file)
+                spider.loop(start=url)
+                spider.save(spider_data_file)
+        else:
+            if http_archive != None:
+                http_archive.begin_record(url)
+            spider = socSpider()
+            if os.path.isfile(spider_data_file):
+                spider.load(spider_data_file)
+            spider.loop(start=url)
+            spider.save(spider_data_file)
+        if http_archive != None:
+            http_archive.close()